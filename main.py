@@ -13,38 +13,54 @@ from typing import Optional, List, Dict, Any, Tuple
 from contextlib import asynccontextmanager
 import asyncpg
 from aiohttp import web, ClientSession
-from aiogram import Bot, Dispatcher, F
+from aiogram import Bot, Dispatcher, Router, F
 from aiogram.types import (
     Message, CallbackQuery, InlineKeyboardMarkup, 
     InlineKeyboardButton, BotCommand, Update
 )
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.filters import Command, StateFilter
+from aiogram.filters.callback_data import CallbackData
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
-from pydantic import BaseModel, Field
+from dataclasses import dataclass
 import re
-from functools import wraps
-from collections import defaultdict
+import random
+from functools import wraps, cache
+from collections import OrderedDict, defaultdict, deque
 import time
+import weakref
+
+try:
+    import uvloop
+except ImportError:  # uvloop недоступен (например, на Windows)
+    uvloop = None
 
 # ==================== КОНФИГУРАЦИЯ ====================
 
+def _env_int(name: str, default: int) -> int:
+    """Целочисленная переменная окружения; пустое значение дает default"""
+    value = os.getenv(name)
+    return int(value) if value else default
+
 class Config:
     """Централизованная конфигурация"""
     BOT_TOKEN = os.getenv("BOT_TOKEN")
     DATABASE_URL = os.getenv("DATABASE_URL")
     
     # Telegram настройки
-    TARGET_CHAT_ID = int(os.getenv("TARGET_CHAT_ID", "-1002827106973"))
-    MODERATION_CHAT_ID = int(os.getenv("MODERATION_CHAT_ID", "0"))
+    TARGET_CHAT_ID = _env_int("TARGET_CHAT_ID", -1002827106973)
+    # Ссылка на сообщение в супергруппе: t.me/c/<id без -100>/<message_id>
+    TARGET_CHAT_URL_PREFIX = f"https://t.me/c/{str(TARGET_CHAT_ID).removeprefix('-100')}/"
+    MODERATION_CHAT_ID = _env_int("MODERATION_CHAT_ID", 0)
     
     # Web настройки
     WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "https://your-app.onrender.com")
     WEBHOOK_PATH = "/webhook"
     WEBHOOK_URL = f"{WEBHOOK_HOST}{WEBHOOK_PATH}"
-    PORT = int(os.getenv("PORT", "10000"))  # Render использует порт 10000 для Python
+    PORT = _env_int("PORT", 10000)  # Render использует порт 10000 для Python
     
     # Бизнес настройки
     GROUP_LINK = os.getenv("GROUP_LINK", "https://t.me/your_group")
@@ -52,11 +68,19 @@ class Config:
     DEFAULT_AD_LIMIT = 4
     RATE_LIMIT_WINDOW = 60
     RATE_LIMIT_MAX_REQUESTS = 10
+    RATE_LIMIT_SWEEP_INTERVAL = 300
+    EDIT_DEBOUNCE = 0.25  # секунды, за которые повторные нажатия схлопываются
+    CACHE_MAX_SIZE = 10000
+    CACHE_SWEEP_INTERVAL = 300
     
     # Database pool настройки
-    DB_MIN_SIZE = 2
-    DB_MAX_SIZE = 8
-    DB_COMMAND_TIMEOUT = 30
+    # min == max: все соединения открываются при старте, поэтому всплеск
+    # нагрузки не ждёт подключения и TLS-рукопожатия к БД; без DB_MAX_SIZE max = min
+    DB_MIN_SIZE = _env_int("DB_MIN_SIZE", 10)
+    DB_MAX_SIZE = _env_int("DB_MAX_SIZE", DB_MIN_SIZE)
+    DB_COMMAND_TIMEOUT = _env_int("DB_COMMAND_TIMEOUT", 30)
+    DB_MAX_QUERIES = _env_int("DB_MAX_QUERIES", 50000)
+    DB_MAX_INACTIVE_CONNECTION_LIFETIME = _env_int("DB_MAX_INACTIVE_CONNECTION_LIFETIME", 600)
     
     @classmethod
     def validate(cls):
@@ -65,28 +89,44 @@ class Config:
             raise ValueError("BOT_TOKEN не установлен!")
         if not cls.DATABASE_URL:
             raise ValueError("DATABASE_URL не установлен!")
+        if cls.DB_MIN_SIZE < 1 or cls.DB_MAX_SIZE < cls.DB_MIN_SIZE:
+            raise ValueError(
+                f"Неверный размер пула БД: DB_MIN_SIZE={cls.DB_MIN_SIZE}, DB_MAX_SIZE={cls.DB_MAX_SIZE} "
+                "(нужно 1 <= DB_MIN_SIZE <= DB_MAX_SIZE)"
+            )
 
 # ==================== МОДЕЛИ ДАННЫХ ====================
 
-class UserAd(BaseModel):
+# Модели создаются только внутри процесса из уже проверенных данных,
+# поэтому это dataclass без валидации при каждом создании
+
+@dataclass(slots=True)
+class UserAd:
     """Модель объявления пользователя"""
-    id: Optional[int] = None
     user_id: int
     message_id: int
     message_url: str
     topic_name: str
+    id: Optional[int] = None
     created_at: Optional[datetime] = None
 
-class TopicInfo(BaseModel):
+@dataclass(frozen=True, slots=True)
+class TopicInfo:
     """Модель информации о теме"""
     name: str
     id: int
 
-class ValidationResult(BaseModel):
+@dataclass(frozen=True, slots=True)
+class ValidationResult:
     """Результат валидации текста"""
     is_valid: bool
     error_message: str = ""
 
+class AdCallback(CallbackData, prefix="ad"):
+    """Callback-данные кнопок управления объявлением"""
+    action: str  # view, delete, cancel_delete, confirm_delete
+    message_id: int
+
 # ==================== СОСТОЯНИЯ FSM ====================
 
 class AdStates(StatesGroup):
@@ -115,12 +155,29 @@ dp: Dispatcher = None
 db_pool: asyncpg.Pool = None
 app: web.Application = None
 
+# Роутер с обработчиками; сообщения из группы объявлений отсекаются фильтром
+# ещё до перебора хендлеров
+router = Router()
+router.message.filter(F.chat.id != Config.TARGET_CHAT_ID)
+
 # Rate limiting и кэширование в памяти
-rate_limiter = defaultdict(list)
-memory_cache = {}
+rate_limiter = defaultdict(deque)
+# LRU: недавно использованные ключи в конце, вытесняются ключи из начала
+memory_cache: OrderedDict = OrderedDict()
+# Загрузки в кэш, которые уже выполняются: ключ -> задача загрузки
+cache_loads: Dict[str, asyncio.Task] = {}
+# Отложенные редактирования меню: (chat_id, message_id) -> задача
+pending_edits: Dict[Tuple[int, int], asyncio.Task] = {}
+# Фоновые уведомления: держим ссылки, чтобы задачи не собрал GC
+notify_tasks = set()
+# Блокировки на чат: запись живёт, пока блокировку кто-то держит
+chat_locks = weakref.WeakValueDictionary()
 
 # ==================== ЛОГИРОВАНИЕ ====================
 
+# Сторонние логгеры, у которых отключаем verbose логи
+QUIET_LOGGERS = ('aiogram', 'aiohttp')
+
 def setup_logging():
     """Настройка логирования"""
     logging.basicConfig(
@@ -129,8 +186,8 @@ def setup_logging():
         handlers=[logging.StreamHandler()]
     )
     # Отключаем verbose логи
-    logging.getLogger('aiogram').setLevel(logging.WARNING)
-    logging.getLogger('aiohttp').setLevel(logging.WARNING)
+    for name in QUIET_LOGGERS:
+        logging.getLogger(name).setLevel(logging.WARNING)
 
 logger = logging.getLogger(__name__)
 
@@ -146,11 +203,12 @@ def rate_limit(max_requests: int = Config.RATE_LIMIT_MAX_REQUESTS,
             if not user_id:
                 return await func(event, *args, **kwargs)
             
-            now = time.time()
+            now = time.monotonic()
             requests = rate_limiter[user_id]
             
-            # Очищаем старые запросы
-            requests[:] = [req_time for req_time in requests if now - req_time < window]
+            # Очищаем старые запросы: метки упорядочены, просроченные всегда слева
+            while requests and now - requests[0] >= window:
+                requests.popleft()
             
             if len(requests) >= max_requests:
                 if hasattr(event, 'answer'):
@@ -162,6 +220,18 @@ def rate_limit(max_requests: int = Config.RATE_LIMIT_MAX_REQUESTS,
         return wrapper
     return decorator
 
+async def start_rate_limiter_sweep_task():
+    """Удаление из rate_limiter пользователей без запросов в текущем окне"""
+    while True:
+        await asyncio.sleep(Config.RATE_LIMIT_SWEEP_INTERVAL)
+        cutoff = time.monotonic() - Config.RATE_LIMIT_WINDOW
+        stale_users = [
+            user_id for user_id, requests in rate_limiter.items()
+            if not requests or requests[-1] < cutoff
+        ]
+        for user_id in stale_users:
+            del rate_limiter[user_id]
+
 def ban_check(func):
     """Декоратор для проверки бана"""
     @wraps(func)
@@ -185,28 +255,114 @@ class CacheService:
         cache_data = memory_cache.get(key)
         if cache_data:
             value, expire_time = cache_data
-            if time.time() < expire_time:
+            if time.monotonic() < expire_time:
+                memory_cache.move_to_end(key)
                 return value
             else:
                 # Удаляем просроченный кэш
-                memory_cache.pop(key, None)
+                del memory_cache[key]
         return None
     
     @staticmethod
     async def set(key: str, value: Any, ttl: int = 300) -> bool:
         """Установить значение в кэш"""
-        expire_time = time.time() + ttl
-        memory_cache[key] = (value, expire_time)
+        # Идущая загрузка этого ключа устарела и не должна перезаписать значение
+        cache_loads.pop(key, None)
+        CacheService._store(key, value, ttl)
         return True
     
+    @staticmethod
+    def _store(key: str, value: Any, ttl: int):
+        """Записать значение в кэш без отмены идущей загрузки"""
+        # Разброс до 10% TTL, чтобы ключи не истекали одновременно
+        expire_time = time.monotonic() + ttl + random.uniform(0, ttl / 10)
+        memory_cache[key] = (value, expire_time)
+        memory_cache.move_to_end(key)
+        # Превышен размер — вытесняем давно не использованные ключи
+        while len(memory_cache) > Config.CACHE_MAX_SIZE:
+            memory_cache.popitem(last=False)
+    
     @staticmethod
     async def delete(key: str) -> bool:
         """Удалить значение из кэша"""
         memory_cache.pop(key, None)
+        cache_loads.pop(key, None)
         return True
+    
+    @staticmethod
+    async def _load(key: str, loader, ttl: int) -> Optional[Any]:
+        """Загрузка для get_or_load: пишет в кэш один раз и только если актуальна
+
+        Если во время загрузки ключ записали или удалили, задача уже убрана
+        из cache_loads, и прочитанное до записи значение в кэш не попадает.
+        """
+        value = await loader()
+        if value is not None and cache_loads.get(key) is asyncio.current_task():
+            CacheService._store(key, value, ttl)
+        return value
+    
+    @staticmethod
+    async def get_or_load(key: str, loader, ttl: int = 300) -> Optional[Any]:
+        """Получить значение из кэша или загрузить его через loader
+
+        Конкурентные промахи по одному ключу ждут одну и ту же загрузку,
+        поэтому в БД уходит один запрос. None не кэшируется.
+        """
+        cached = await CacheService.get(key)
+        if cached is not None:
+            return cached
+        
+        task = cache_loads.get(key)
+        if task is None:
+            task = asyncio.ensure_future(CacheService._load(key, loader, ttl))
+            cache_loads[key] = task
+            # Убираем только свою задачу: ключ мог уже занять более новый загрузчик
+            task.add_done_callback(
+                lambda done: cache_loads.pop(key) if cache_loads.get(key) is done else None
+            )
+        
+        return await asyncio.shield(task)
+
+async def start_cache_sweep_task():
+    """Удаление просроченных ключей, которые больше никто не запрашивает"""
+    while True:
+        await asyncio.sleep(Config.CACHE_SWEEP_INTERVAL)
+        now = time.monotonic()
+        expired_keys = [
+            key for key, (_, expire_time) in memory_cache.items()
+            if expire_time <= now
+        ]
+        for key in expired_keys:
+            memory_cache.pop(key, None)
 
 # ==================== БАЗА ДАННЫХ ====================
 
+# SQL держим в константах: asyncpg подготавливает каждый запрос один раз
+# на соединение и дальше берёт его из кэша statement соединения
+USER_ADS_SQL = """SELECT message_id, message_url, topic_name,
+                         ROW_NUMBER() OVER (PARTITION BY topic_name
+                                            ORDER BY created_at DESC, id DESC) AS topic_number
+                  FROM user_ads WHERE user_id = $1 
+                  ORDER BY created_at DESC, id DESC"""
+IS_BANNED_SQL = "SELECT 1 FROM banned_users WHERE user_id = $1"
+USER_LIMIT_SQL = "SELECT ad_limit FROM user_limits WHERE user_id = $1"
+
+# Количество объявлений и лимит пользователя для /getlimit одним запросом
+USER_STATS_SQL = """SELECT (SELECT COUNT(*) FROM user_ads WHERE user_id = $1) AS ads_count,
+                           (SELECT ad_limit FROM user_limits WHERE user_id = $1) AS ad_limit"""
+
+# Запросы на запись
+ADD_USER_AD_SQL = """INSERT INTO user_ads (user_id, message_id, message_url, topic_name) 
+                     VALUES ($1, $2, $3, $4) RETURNING id, created_at"""
+DELETE_USER_AD_SQL = "DELETE FROM user_ads WHERE message_id = $1 RETURNING user_id"
+BAN_USER_SQL = """INSERT INTO banned_users (user_id) 
+                  VALUES ($1) ON CONFLICT (user_id) DO NOTHING"""
+UNBAN_USER_SQL = "DELETE FROM banned_users WHERE user_id = $1"
+SET_USER_LIMIT_SQL = """INSERT INTO user_limits (user_id, ad_limit) 
+                        VALUES ($1, $2) 
+                        ON CONFLICT (user_id) 
+                        DO UPDATE SET ad_limit = $2, updated_at = CURRENT_TIMESTAMP"""
+
 @asynccontextmanager
 async def get_db_connection():
     """Context manager для получения соединения с БД"""
@@ -214,9 +370,16 @@ async def get_db_connection():
         try:
             yield connection
         except Exception as e:
-            logger.error(f"Database error: {e}")
+            logger.error("Database error: %s", e)
             raise
 
+async def _skip_connection_reset(connection: asyncpg.Connection):
+    """Пропуск reset-запроса при возврате соединения в пул.
+
+    Обработчики не используют LISTEN, advisory locks и SET на уровне сессии,
+    поэтому сбрасывать состояние соединения не нужно.
+    """
+
 class DatabaseService:
     """Сервис работы с базой данных"""
     
@@ -228,14 +391,9 @@ class DatabaseService:
         Config.validate()
         
         try:
-            db_pool = await asyncpg.create_pool(
-                Config.DATABASE_URL,
-                min_size=Config.DB_MIN_SIZE,
-                max_size=Config.DB_MAX_SIZE,
-                command_timeout=Config.DB_COMMAND_TIMEOUT
-            )
-            
-            async with get_db_connection() as conn:
+            # Схема создается на отдельном соединении до создания пула
+            conn = await asyncpg.connect(Config.DATABASE_URL)
+            try:
                 # Создание основных таблиц
                 await conn.execute("""
                     CREATE TABLE IF NOT EXISTS user_ads (
@@ -263,24 +421,44 @@ class DatabaseService:
                     )
                 """)
                 
-                # Создание индексов
-                indexes = [
-                    "CREATE INDEX IF NOT EXISTS idx_user_ads_user_id ON user_ads(user_id)",
-                    "CREATE INDEX IF NOT EXISTS idx_user_ads_message_id ON user_ads(message_id)",
-                    "CREATE INDEX IF NOT EXISTS idx_user_ads_created_at ON user_ads(created_at DESC)",
-                ]
+                # Создание индексов: DDL выполняется только для отсутствующих,
+                # чтобы не брать блокировку user_ads на каждом деплое
+                indexes = {
+                    "idx_user_ads_user_id": "CREATE INDEX IF NOT EXISTS idx_user_ads_user_id ON user_ads(user_id)",
+                    "idx_user_ads_message_id": "CREATE INDEX IF NOT EXISTS idx_user_ads_message_id ON user_ads(message_id)",
+                    "idx_user_ads_created_at": "CREATE INDEX IF NOT EXISTS idx_user_ads_created_at ON user_ads(created_at DESC)",
+                }
+                existing_indexes = {
+                    row['indexname'] for row in await conn.fetch(
+                        "SELECT indexname FROM pg_indexes WHERE tablename = 'user_ads'"
+                    )
+                }
                 
-                for index_sql in indexes:
+                for index_name, index_sql in indexes.items():
+                    if index_name in existing_indexes:
+                        continue
                     try:
                         await conn.execute(index_sql)
                     except Exception as e:
                         if "already exists" not in str(e):
-                            logger.warning(f"Index creation warning: {e}")
+                            logger.warning("Index creation warning: %s", e)
+            finally:
+                await conn.close()
+            
+            db_pool = await asyncpg.create_pool(
+                Config.DATABASE_URL,
+                min_size=Config.DB_MIN_SIZE,
+                max_size=Config.DB_MAX_SIZE,
+                command_timeout=Config.DB_COMMAND_TIMEOUT,
+                max_queries=Config.DB_MAX_QUERIES,
+                max_inactive_connection_lifetime=Config.DB_MAX_INACTIVE_CONNECTION_LIFETIME,
+                reset=_skip_connection_reset
+            )
             
             logger.info("✅ База данных успешно инициализирована")
             
         except Exception as e:
-            logger.error(f"❌ Ошибка инициализации БД: {e}")
+            logger.error("❌ Ошибка инициализации БД: %s", e)
             raise
     
     @staticmethod
@@ -288,142 +466,115 @@ class DatabaseService:
         """Добавить объявление пользователя"""
         try:
             async with get_db_connection() as conn:
-                await conn.execute(
-                    """INSERT INTO user_ads (user_id, message_id, message_url, topic_name) 
-                       VALUES ($1, $2, $3, $4)""",
+                # id и created_at назначает сервер — получаем их тем же запросом
+                user_ad.id, user_ad.created_at = await conn.fetchrow(
+                    ADD_USER_AD_SQL,
                     user_ad.user_id, user_ad.message_id, user_ad.message_url, user_ad.topic_name
                 )
-                
-                # Инвалидируем кэш
-                await CacheService.delete(f"user_ads:{user_ad.user_id}")
-                await CacheService.delete(f"user_ad_count:{user_ad.user_id}")
-                return True
+            
+            # Новое объявление самое свежее: добавляем его в начало закэшированного
+            # списка вместо перечитывания из БД, номера в его теме сдвигаются на 1
+            key = f"user_ads:{user_ad.user_id}"
+            ads = await CacheService.get(key)
+            if ads is not None:
+                await CacheService.set(key, [
+                    (user_ad.message_id, user_ad.message_url, user_ad.topic_name, 1),
+                    *(
+                        (message_id, message_url, topic_name,
+                         topic_number + 1 if topic_name == user_ad.topic_name else topic_number)
+                        for message_id, message_url, topic_name, topic_number in ads
+                    )
+                ], 300)
+            else:
+                # Списка в кэше нет, но загрузка могла начаться до INSERT —
+                # сбрасываем её, чтобы в кэш не попал список без нового объявления
+                await CacheService.delete(key)
+            return True
         except Exception as e:
-            logger.error(f"Ошибка добавления объявления: {e}")
+            logger.error("Ошибка добавления объявления: %s", e)
             return False
     
     @staticmethod
-    async def get_user_ads(user_id: int) -> List[Tuple[int, str, str]]:
-        """Получить объявления пользователя с кэшированием"""
-        cache_key = f"user_ads:{user_id}"
-        cached = await CacheService.get(cache_key)
-        if cached:
-            return cached
+    async def get_user_ads(user_id: int) -> List[Tuple[int, str, str, int]]:
+        """Получить объявления пользователя с кэшированием
+
+        Последний элемент кортежа — порядковый номер объявления в своей теме.
+        """
+        async def load():
+            async with get_db_connection() as conn:
+                rows = await conn.fetch(USER_ADS_SQL, user_id)
+            return [tuple(row) for row in rows]
         
         try:
-            async with get_db_connection() as conn:
-                rows = await conn.fetch(
-                    """SELECT message_id, message_url, topic_name 
-                       FROM user_ads WHERE user_id = $1 
-                       ORDER BY created_at DESC""",
-                    user_id
-                )
-                result = [(row['message_id'], row['message_url'], row['topic_name']) for row in rows]
-                await CacheService.set(cache_key, result, 300)
-                return result
+            return await CacheService.get_or_load(f"user_ads:{user_id}", load, 300)
         except Exception as e:
-            logger.error(f"Ошибка получения объявлений: {e}")
+            logger.error("Ошибка получения объявлений: %s", e)
             return []
     
     @staticmethod
-    async def get_user_ads_with_counts(user_id: int) -> List[Tuple[int, str, str, str]]:
-        """Получить объявления с нумерацией по темам"""
+    async def get_user_ad(user_id: int, message_id: int) -> Optional[Tuple[int, str, str, int]]:
+        """Найти объявление среди объявлений пользователя
+
+        Берётся из того же кэша, что и список «Мои объявления», поэтому
+        переходы по кнопкам не ходят в БД, а принадлежность проверяется
+        самим поиском.
+        """
         ads = await DatabaseService.get_user_ads(user_id)
-        
-        topic_counts = defaultdict(int)
-        result = []
-        
-        for message_id, message_url, topic_name in ads:
-            topic_counts[topic_name] += 1
-            topic_display = f"{topic_name} {topic_counts[topic_name]}"
-            result.append((message_id, message_url, topic_display, topic_name))
-        
-        return result
+        return next((ad for ad in ads if ad[0] == message_id), None)
     
     @staticmethod
-    async def get_ad_by_message_id(message_id: int) -> Optional[Tuple[int, int, str, str]]:
-        """Получить объявление по message_id с кэшированием"""
-        cache_key = f"ad:{message_id}"
-        cached = await CacheService.get(cache_key)
-        if cached:
-            return tuple(cached)
-        
-        try:
-            async with get_db_connection() as conn:
-                row = await conn.fetchrow(
-                    """SELECT user_id, message_id, message_url, topic_name 
-                       FROM user_ads WHERE message_id = $1""",
-                    message_id
-                )
-                if row:
-                    result = (row['user_id'], row['message_id'], row['message_url'], row['topic_name'])
-                    await CacheService.set(cache_key, result, 600)
-                    return result
-                return None
-        except Exception as e:
-            logger.error(f"Ошибка получения объявления: {e}")
-            return None
+    async def get_user_ads_with_counts(user_id: int) -> List[Tuple[int, str, str, str]]:
+        """Получить объявления с нумерацией по темам"""
+        ads = await DatabaseService.get_user_ads(user_id)
+        return [
+            (message_id, message_url, f"{topic_name} {topic_number}", topic_name)
+            for message_id, message_url, topic_name, topic_number in ads
+        ]
     
     @staticmethod
     async def delete_user_ad(message_id: int) -> bool:
         """Удалить объявление"""
         try:
+            # RETURNING отдает user_id для инвалидации кэша без отдельного SELECT
             async with get_db_connection() as conn:
-                # Получаем user_id для инвалидации кэша
-                row = await conn.fetchrow(
-                    "SELECT user_id FROM user_ads WHERE message_id = $1", message_id
-                )
-                
-                if row:
-                    user_id = row['user_id']
-                    await conn.execute(
-                        "DELETE FROM user_ads WHERE message_id = $1", message_id
-                    )
-                    
-                    # Инвалидируем кэш
-                    await CacheService.delete(f"user_ads:{user_id}")
-                    await CacheService.delete(f"user_ad_count:{user_id}")
-                    await CacheService.delete(f"ad:{message_id}")
-                    return True
-                return False
+                user_id = await conn.fetchval(DELETE_USER_AD_SQL, message_id)
+            
+            if user_id is not None:
+                # Инвалидируем кэш
+                await CacheService.delete(f"user_ads:{user_id}")
+                return True
+            return False
         except Exception as e:
-            logger.error(f"Ошибка удаления объявления: {e}")
+            logger.error("Ошибка удаления объявления: %s", e)
             return False
     
     @staticmethod
     async def get_user_ad_count(user_id: int) -> int:
-        """Получить количество объявлений с кэшированием"""
-        cache_key = f"user_ad_count:{user_id}"
-        cached = await CacheService.get(cache_key)
-        if cached is not None:
-            return cached
-        
+        """Получить количество объявлений из кэшированного списка"""
+        return len(await DatabaseService.get_user_ads(user_id))
+
+    @staticmethod
+    async def get_user_stats(user_id: int) -> Tuple[int, int]:
+        """Получить количество объявлений и лимит одним запросом"""
         try:
-            async with get_db_connection() as conn:
-                result = await conn.fetchval(
-                    "SELECT COUNT(*) FROM user_ads WHERE user_id = $1", user_id
-                )
-                count = result if result else 0
-                await CacheService.set(cache_key, count, 60)
-                return count
+            row = await db_pool.fetchrow(USER_STATS_SQL, user_id)
+            limit = row['ad_limit'] if row['ad_limit'] is not None else Config.DEFAULT_AD_LIMIT
+            return row['ads_count'], limit
         except Exception as e:
-            logger.error(f"Ошибка подсчета объявлений: {e}")
-            return 0
-    
+            logger.error("Ошибка получения статистики пользователя: %s", e)
+            return 0, Config.DEFAULT_AD_LIMIT
+
     @staticmethod
     async def ban_user(user_id: int) -> bool:
         """Забанить пользователя"""
         try:
             async with get_db_connection() as conn:
-                await conn.execute(
-                    """INSERT INTO banned_users (user_id) 
-                       VALUES ($1) ON CONFLICT (user_id) DO NOTHING""",
-                    user_id
-                )
-                await CacheService.delete(f"banned:{user_id}")
-                return True
+                await conn.execute(BAN_USER_SQL, user_id)
+            # Записываем новый статус сразу, чтобы следующая проверка не шла в БД
+            await CacheService.set(f"banned:{user_id}", True, 300)
+            return True
         except Exception as e:
-            logger.error(f"Ошибка бана пользователя: {e}")
+            logger.error("Ошибка бана пользователя: %s", e)
             return False
     
     @staticmethod
@@ -431,17 +582,36 @@ class DatabaseService:
         """Разбанить пользователя"""
         try:
             async with get_db_connection() as conn:
-                await conn.execute(
-                    "DELETE FROM banned_users WHERE user_id = $1", user_id
-                )
-                await CacheService.delete(f"banned:{user_id}")
-                return True
+                await conn.execute(UNBAN_USER_SQL, user_id)
+            await CacheService.set(f"banned:{user_id}", False, 300)
+            return True
         except Exception as e:
-            logger.error(f"Ошибка разбана пользователя: {e}")
+            logger.error("Ошибка разбана пользователя: %s", e)
             return False
 
 # ==================== ВАЛИДАЦИЯ ====================
 
+# Шаблоны ссылок и доменов компилируются один раз при импорте
+URL_PATTERN = re.compile(r'https?://', re.IGNORECASE)
+DOMAIN_PATTERN = re.compile(r'\b[a-zA-Z0-9](?:[a-zA-Z0-9\-]{0,61}[a-zA-Z0-9])?\.[a-zA-Z]{2,}\b')
+
+# Экранирование пользовательского текста для parse_mode="HTML" за один проход
+HTML_ESCAPE_TABLE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;'})
+
+# Результаты валидации только читаются, поэтому создаются один раз
+VALIDATION_OK = ValidationResult(is_valid=True)
+VALIDATION_ERRORS: Dict[str, ValidationResult] = {
+    name: ValidationResult(is_valid=False, error_message=message)
+    for name, message in {
+        "empty": "❌ Сообщение не может быть пустым!",
+        "too_long": "❌ Сообщение слишком длинное (максимум 4000 символов)!",
+        "username": "❌ @username не принимаются, мы сами вставим ссылку на вас.",
+        "url": "❌ Ссылки не принимаются, мы сами вставим ссылку на вас.",
+        "hashtag": "❌ Хэштеги не принимаются, мы сами вставим ссылку на вас.",
+        "domain": "❌ Сайты не принимаются, мы сами вставим ссылку на вас.",
+    }.items()
+}
+
 class ValidationService:
     """Сервис валидации данных"""
     
@@ -449,101 +619,98 @@ class ValidationService:
     def validate_message_text(text: str) -> ValidationResult:
         """Валидация текста сообщения"""
         if not text or not text.strip():
-            return ValidationResult(is_valid=False, error_message="❌ Сообщение не может быть пустым!")
+            return VALIDATION_ERRORS["empty"]
         
         if len(text) > 4000:
-            return ValidationResult(is_valid=False, error_message="❌ Сообщение слишком длинное (максимум 4000 символов)!")
+            return VALIDATION_ERRORS["too_long"]
         
         # Проверяем на @username
         if '@' in text:
-            return ValidationResult(is_valid=False, error_message="❌ @username не принимаются, мы сами вставим ссылку на вас.")
+            return VALIDATION_ERRORS["username"]
         
-        # Проверяем на URL
-        if re.search(r'https?://', text, re.IGNORECASE):
-            return ValidationResult(is_valid=False, error_message="❌ Ссылки не принимаются, мы сами вставим ссылку на вас.")
+        # Проверяем на URL (без ':' ссылки быть не может — regex не запускаем)
+        if ':' in text and URL_PATTERN.search(text):
+            return VALIDATION_ERRORS["url"]
         
         # Проверяем на хэштеги
         if '#' in text:
-            return ValidationResult(is_valid=False, error_message="❌ Хэштеги не принимаются, мы сами вставим ссылку на вас.")
+            return VALIDATION_ERRORS["hashtag"]
         
-        # Проверяем на домены
-        domain_pattern = r'\b[a-zA-Z0-9]([a-zA-Z0-9\-]{0,61}[a-zA-Z0-9])?\.([a-zA-Z]{2,})\b'
-        if re.search(domain_pattern, text):
-            return ValidationResult(is_valid=False, error_message="❌ Сайты не принимаются, мы сами вставим ссылку на вас.")
+        # Проверяем на домены (без '.' домена быть не может)
+        if '.' in text and DOMAIN_PATTERN.search(text):
+            return VALIDATION_ERRORS["domain"]
         
-        return ValidationResult(is_valid=True)
+        return VALIDATION_OK
 
 # ==================== УТИЛИТЫ ====================
 
 async def is_user_banned(user_id: int) -> bool:
     """Проверить бан пользователя с кэшированием"""
-    cache_key = f"banned:{user_id}"
-    cached = await CacheService.get(cache_key)
-    if cached is not None:
-        return cached
+    async def load():
+        async with get_db_connection() as conn:
+            result = await conn.fetchval(IS_BANNED_SQL, user_id)
+        return result is not None
     
     try:
-        async with get_db_connection() as conn:
-            result = await conn.fetchval(
-                "SELECT 1 FROM banned_users WHERE user_id = $1", user_id
-            )
-            is_banned = result is not None
-            await CacheService.set(cache_key, is_banned, 300)
-            return is_banned
+        return await CacheService.get_or_load(f"banned:{user_id}", load, 300)
     except Exception as e:
-        logger.error(f"Ошибка проверки бана: {e}")
+        logger.error("Ошибка проверки бана: %s", e)
         return False
 
 async def get_user_limit(user_id: int) -> int:
     """Получить лимит пользователя с кэшированием"""
-    cache_key = f"user_limit:{user_id}"
-    cached = await CacheService.get(cache_key)
-    if cached is not None:
-        return cached
+    async def load():
+        async with get_db_connection() as conn:
+            result = await conn.fetchval(USER_LIMIT_SQL, user_id)
+        return result if result is not None else Config.DEFAULT_AD_LIMIT
     
     try:
-        async with get_db_connection() as conn:
-            result = await conn.fetchval(
-                "SELECT ad_limit FROM user_limits WHERE user_id = $1", user_id
-            )
-            limit = result if result else Config.DEFAULT_AD_LIMIT
-            await CacheService.set(cache_key, limit, 600)
-            return limit
+        return await CacheService.get_or_load(f"user_limit:{user_id}", load, 600)
     except Exception as e:
-        logger.error(f"Ошибка получения лимита: {e}")
+        logger.error("Ошибка получения лимита: %s", e)
         return Config.DEFAULT_AD_LIMIT
 
 async def set_user_limit(user_id: int, limit: int):
     """Установить лимит объявлений для пользователя"""
     try:
         async with get_db_connection() as conn:
-            await conn.execute(
-                """INSERT INTO user_limits (user_id, ad_limit) 
-                   VALUES ($1, $2) 
-                   ON CONFLICT (user_id) 
-                   DO UPDATE SET ad_limit = $2, updated_at = CURRENT_TIMESTAMP""",
-                user_id, limit
-            )
-            # Инвалидируем кэш
-            await CacheService.delete(f"user_limit:{user_id}")
+            await conn.execute(SET_USER_LIMIT_SQL, user_id, limit)
+        # Обновляем кэш новым значением вместо инвалидации
+        await CacheService.set(f"user_limit:{user_id}", limit, 600)
     except Exception as e:
-        logger.error(f"Ошибка установки лимита: {e}")
+        logger.error("Ошибка установки лимита: %s", e)
 
 async def notify_user(user_id: int, message: str) -> bool:
     """Уведомить пользователя"""
     try:
-        await bot.send_message(chat_id=user_id, text=message)
+        try:
+            await bot.send_message(chat_id=user_id, text=message)
+        except TelegramRetryAfter as e:
+            # Flood control: ждём, сколько просит Telegram, и пробуем ещё раз
+            await asyncio.sleep(e.retry_after)
+            await bot.send_message(chat_id=user_id, text=message)
         return True
     except Exception as e:
-        logger.error(f"Ошибка уведомления пользователя {user_id}: {e}")
+        logger.error("Ошибка уведомления пользователя %s: %s", user_id, e)
         return False
 
+def notify_user_background(user_id: int, message: str):
+    """Уведомить пользователя, не дожидаясь ответа Telegram"""
+    task = asyncio.create_task(notify_user(user_id, message))
+    notify_tasks.add(task)
+    task.add_done_callback(notify_tasks.discard)
+
 # ==================== КЛАВИАТУРЫ ====================
 
 class KeyboardService:
-    """Сервис создания клавиатур"""
+    """Сервис создания клавиатур
+
+    Статические клавиатуры зависят только от констант, поэтому строятся
+    один раз и дальше переиспользуются.
+    """
     
     @staticmethod
+    @cache
     def get_language_keyboard() -> InlineKeyboardMarkup:
         return InlineKeyboardMarkup(inline_keyboard=[
             [
@@ -553,6 +720,7 @@ class KeyboardService:
         ])
     
     @staticmethod
+    @cache
     def get_main_menu_keyboard() -> InlineKeyboardMarkup:
         return InlineKeyboardMarkup(inline_keyboard=[
             [
@@ -564,32 +732,60 @@ class KeyboardService:
         ])
     
     @staticmethod
+    @cache
     def get_topics_keyboard() -> InlineKeyboardMarkup:
-        buttons = []
-        topic_items = list(TOPICS.items())
-        
-        for i in range(0, len(topic_items), 2):
-            row = []
-            topic_key, topic_data = topic_items[i]
-            row.append(InlineKeyboardButton(
-                text=topic_data.name, 
-                callback_data=topic_key
-            ))
-            
-            if i + 1 < len(topic_items):
-                topic_key2, topic_data2 = topic_items[i + 1]
-                row.append(InlineKeyboardButton(
-                    text=topic_data2.name, 
-                    callback_data=topic_key2
-                ))
-            
-            buttons.append(row)
-        
+        topic_buttons = [
+            InlineKeyboardButton(text=topic_data.name, callback_data=topic_key)
+            for topic_key, topic_data in TOPICS.items()
+        ]
+        # По две темы в ряд
+        buttons = [topic_buttons[i:i + 2] for i in range(0, len(topic_buttons), 2)]
         buttons.append([
             InlineKeyboardButton(text="⬅️ Назад", callback_data="back_to_main")
         ])
         
         return InlineKeyboardMarkup(inline_keyboard=buttons)
+    
+    @staticmethod
+    @cache
+    def get_writing_ad_keyboard() -> InlineKeyboardMarkup:
+        return InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="📖 Пример заполнения", url=Config.EXAMPLE_URL)],
+            [InlineKeyboardButton(text="⬅️ Назад", callback_data="back_to_topics")]
+        ])
+    
+    @staticmethod
+    @cache
+    def get_home_keyboard() -> InlineKeyboardMarkup:
+        return InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="🏠 На главную", callback_data="back_to_main")]
+        ])
+    
+    @staticmethod
+    @cache
+    def get_no_ads_keyboard() -> InlineKeyboardMarkup:
+        return InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="⬅️ В главное меню", callback_data="back_to_main")]
+        ])
+    
+    @staticmethod
+    def get_ad_actions_keyboard(message_id: int, message_url: str) -> InlineKeyboardMarkup:
+        return InlineKeyboardMarkup(inline_keyboard=[
+            [
+                InlineKeyboardButton(text="🗑 Удалить", callback_data=AdCallback(action="delete", message_id=message_id).pack()),
+            ],
+            [InlineKeyboardButton(text="👁 Посмотреть", url=message_url)],
+            [InlineKeyboardButton(text="⬅️ Назад", callback_data="back_to_my_ads")]
+        ])
+    
+    @staticmethod
+    def get_delete_confirm_keyboard(message_id: int) -> InlineKeyboardMarkup:
+        return InlineKeyboardMarkup(inline_keyboard=[
+            [
+                InlineKeyboardButton(text="❌ Отмена", callback_data=AdCallback(action="cancel_delete", message_id=message_id).pack()),
+                InlineKeyboardButton(text="✅ Удалить", callback_data=AdCallback(action="confirm_delete", message_id=message_id).pack())
+            ]
+        ])
 
 async def get_my_ads_keyboard(user_id: int):
     """Клавиатура с объявлениями пользователя"""
@@ -600,7 +796,7 @@ async def get_my_ads_keyboard(user_id: int):
         buttons.append([
             InlineKeyboardButton(
                 text=f"📄 {topic_display}", 
-                callback_data=f"view_ad_{message_id}"
+                callback_data=AdCallback(action="view", message_id=message_id).pack()
             )
         ])
     
@@ -611,15 +807,58 @@ async def get_my_ads_keyboard(user_id: int):
     
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
+# ==================== РЕДАКТИРОВАНИЕ МЕНЮ ====================
+
+def get_chat_lock(chat_id: int) -> asyncio.Lock:
+    """Блокировка, сериализующая изменения сообщений в одном чате"""
+    lock = chat_locks.get(chat_id)
+    if lock is None:
+        lock = chat_locks[chat_id] = asyncio.Lock()
+    return lock
+
+async def _deferred_edit(key: Tuple[int, int], message: Message, text: str,
+                         reply_markup: Optional[InlineKeyboardMarkup]):
+    """Редактирование сообщения после паузы EDIT_DEBOUNCE"""
+    try:
+        await asyncio.sleep(Config.EDIT_DEBOUNCE)
+        async with get_chat_lock(message.chat.id):
+            await message.edit_text(text, reply_markup=reply_markup)
+    except Exception as e:
+        logger.warning("Не удалось отредактировать сообщение %s: %s", message.message_id, e)
+    finally:
+        if pending_edits.get(key) is asyncio.current_task():
+            del pending_edits[key]
+
+def cancel_pending_edit(message: Message) -> Tuple[int, int]:
+    """Отменить отложенное редактирование сообщения, если оно ещё не ушло
+
+    Вызывается перед любым редактированием сообщения, в том числе прямым,
+    чтобы устаревший экран не перерисовал более новый.
+    """
+    key = (message.chat.id, message.message_id)
+    pending = pending_edits.pop(key, None)
+    if pending:
+        pending.cancel()
+    return key
+
+def schedule_edit(message: Message, text: str,
+                  reply_markup: Optional[InlineKeyboardMarkup] = None):
+    """Отложенное редактирование меню
+
+    Если пользователь быстро нажимает кнопки, промежуточные редактирования
+    отменяются и в Telegram уходит только последнее.
+    """
+    key = cancel_pending_edit(message)
+    pending_edits[key] = asyncio.create_task(
+        _deferred_edit(key, message, text, reply_markup)
+    )
+
 # ==================== ОБРАБОТЧИКИ ====================
 
-@dp.message(Command("start"))
+@router.message(Command("start"))
 @rate_limit()
 async def start_handler(message: Message, state: FSMContext):
     """Стартовый обработчик"""
-    if message.chat.id == Config.TARGET_CHAT_ID:
-        return
-    
     if await is_user_banned(message.from_user.id):
         await message.answer("🚫 Вы заблокированы в этом боте.")
         return
@@ -630,58 +869,63 @@ async def start_handler(message: Message, state: FSMContext):
     )
     await state.set_state(AdStates.choosing_language)
 
-@dp.callback_query(F.data == "lang_ru", StateFilter(AdStates.choosing_language))
+@router.callback_query(F.data == "lang_ru", StateFilter(AdStates.choosing_language))
 @rate_limit()
 @ban_check
 async def language_ru_handler(callback: CallbackQuery, state: FSMContext):
     """Выбор русского языка"""
-    await callback.message.edit_text(
+    schedule_edit(
+        callback.message,
         "🏠 Главное меню:",
         reply_markup=KeyboardService.get_main_menu_keyboard()
     )
     await state.set_state(AdStates.main_menu)
     await callback.answer()
 
-@dp.callback_query(F.data == "lang_en", StateFilter(AdStates.choosing_language))
+@router.callback_query(F.data == "lang_en", StateFilter(AdStates.choosing_language))
 @rate_limit()
 async def language_en_handler(callback: CallbackQuery, state: FSMContext):
     """Выбор английского языка (заглушка)"""
     await callback.answer("🚧 English version coming soon!", show_alert=True)
 
-@dp.callback_query(F.data == "create_ad")
+@router.callback_query(F.data == "create_ad")
 @rate_limit()
 @ban_check
 async def create_ad_handler(callback: CallbackQuery, state: FSMContext):
     """Создание объявления"""
-    await callback.message.edit_text(
+    schedule_edit(
+        callback.message,
         "📝 В какую тему хотите написать?",
         reply_markup=KeyboardService.get_topics_keyboard()
     )
     await state.set_state(AdStates.choosing_topic)
     await callback.answer()
 
-@dp.callback_query(F.data == "my_ads")
+@router.callback_query(F.data == "my_ads")
 @rate_limit()
 @ban_check
 async def my_ads_handler(callback: CallbackQuery, state: FSMContext):
     """Мои объявления"""
     user_id = callback.from_user.id
-    ads = await DatabaseService.get_user_ads(user_id)
-    user_limit = await get_user_limit(user_id)
+    ads, user_limit = await asyncio.gather(
+        DatabaseService.get_user_ads(user_id),
+        get_user_limit(user_id)
+    )
     
     if not ads:
         await callback.answer("📭 У вас пока нет объявлений", show_alert=True)
         return
     
     keyboard = await get_my_ads_keyboard(user_id)
-    await callback.message.edit_text(
+    schedule_edit(
+        callback.message,
         f"📋 Ваши объявления ({len(ads)}/{user_limit}):",
         reply_markup=keyboard
     )
     await state.set_state(AdStates.my_ads)
     await callback.answer()
 
-@dp.callback_query(StateFilter(AdStates.choosing_topic))
+@router.callback_query(StateFilter(AdStates.choosing_topic))
 @rate_limit()
 @ban_check
 async def topic_handler(callback: CallbackQuery, state: FSMContext):
@@ -692,39 +936,31 @@ async def topic_handler(callback: CallbackQuery, state: FSMContext):
         await state.update_data(selected_topic=topic_key)
         
         topic_name = TOPICS[topic_key].name
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="📖 Пример заполнения", url=Config.EXAMPLE_URL)],
-            [InlineKeyboardButton(text="⬅️ Назад", callback_data="back_to_topics")]
-        ])
-        
-        await callback.message.edit_text(
+        schedule_edit(
+            callback.message,
             f"✍️ Тема: {topic_name}\n\nНапишите объявление и отправьте:",
-            reply_markup=keyboard
+            reply_markup=KeyboardService.get_writing_ad_keyboard()
         )
         await state.set_state(AdStates.writing_ad)
     
     await callback.answer()
 
-@dp.message(StateFilter(AdStates.writing_ad))
+@router.message(StateFilter(AdStates.writing_ad))
 @rate_limit()
 @ban_check
 async def ad_text_handler(message: Message, state: FSMContext):
     """Обработка текста объявления"""
-    if message.chat.id == Config.TARGET_CHAT_ID:
-        return
-    
     # Проверяем лимит
     user_id = message.from_user.id
-    current_count = await DatabaseService.get_user_ad_count(user_id)
-    user_limit = await get_user_limit(user_id)
+    current_count, user_limit = await asyncio.gather(
+        DatabaseService.get_user_ad_count(user_id),
+        get_user_limit(user_id)
+    )
     
     if current_count >= user_limit:
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🏠 На главную", callback_data="back_to_main")]
-        ])
         await message.answer(
             f"❌ Превышен лимит объявлений!\n\nУ вас: {current_count}/{user_limit} объявлений\n\nУдалите старые объявления через 'Мои объявления'",
-            reply_markup=keyboard
+            reply_markup=KeyboardService.get_home_keyboard()
         )
         await state.clear()
         return
@@ -746,17 +982,14 @@ async def ad_text_handler(message: Message, state: FSMContext):
         await message.answer(validation.error_message)
         return
     
-    # Форматирование
-    lines = ad_text.split('\n')
-    formatted_text = f"<blockquote>{lines[0]}</blockquote>"
-    if len(lines) > 1:
-        formatted_text += "\n" + "\n".join(lines[1:])
+    # Форматирование: первая строка в цитате, остальное как есть
+    head, sep, tail = ad_text.translate(HTML_ESCAPE_TABLE).partition('\n')
     
     # Добавляем ссылку на автора
     contact_url = (f"https://t.me/{message.from_user.username}" 
                   if message.from_user.username 
                   else f"tg://user?id={message.from_user.id}")
-    formatted_text += f'\n\n<a href="{contact_url}">—</a>'
+    formatted_text = f'<blockquote>{head}</blockquote>{sep}{tail}\n\n<a href="{contact_url}">—</a>'
     
     try:
         # Публикуем
@@ -768,7 +1001,7 @@ async def ad_text_handler(message: Message, state: FSMContext):
         )
         
         # Сохраняем
-        message_url = f"https://t.me/c/{str(Config.TARGET_CHAT_ID)[4:]}/{sent_message.message_id}"
+        message_url = f"{Config.TARGET_CHAT_URL_PREFIX}{sent_message.message_id}"
         
         user_ad = UserAd(
             user_id=user_id,
@@ -796,13 +1029,10 @@ async def ad_text_handler(message: Message, state: FSMContext):
             reply_markup=keyboard
         )
         
-        logger.info(f"Объявление опубликовано: пользователь {user_id}, тема {selected_topic}")
+        logger.info("Объявление опубликовано: пользователь %s, тема %s", user_id, selected_topic)
         
     except Exception as e:
-        logger.error(f"Ошибка публикации: {e}")
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🏠 На главную", callback_data="back_to_main")]
-        ])
+        logger.error("Ошибка публикации: %s", e)
         
         if "not enough rights" in str(e):
             error_msg = "❌ Ошибка: бот не имеет прав для отправки сообщений в группу"
@@ -813,44 +1043,47 @@ async def ad_text_handler(message: Message, state: FSMContext):
         else:
             error_msg = "❌ Ошибка при публикации. Попробуйте позже."
         
-        await message.answer(error_msg, reply_markup=keyboard)
+        await message.answer(error_msg, reply_markup=KeyboardService.get_home_keyboard())
     
     await state.clear()
 
 # ==================== НАВИГАЦИЯ ====================
 
-@dp.callback_query(F.data == "back_to_language")
+@router.callback_query(F.data == "back_to_language")
 async def back_to_language_handler(callback: CallbackQuery, state: FSMContext):
     """Возврат к выбору языка"""
     try:
-        await callback.message.edit_text(
+        schedule_edit(
+            callback.message,
             "🌍 Выберите язык / Choose language:",
             reply_markup=KeyboardService.get_language_keyboard()
         )
         await state.set_state(AdStates.choosing_language)
         await callback.answer()
     except Exception as e:
-        logger.warning(f"Ошибка при возврате к языку: {e}")
+        logger.warning("Ошибка при возврате к языку: %s", e)
         await callback.answer()
 
-@dp.callback_query(F.data == "back_to_main")
+@router.callback_query(F.data == "back_to_main")
 async def back_to_main_handler(callback: CallbackQuery, state: FSMContext):
     """Возврат в главное меню"""
     try:
-        await callback.message.edit_text(
+        schedule_edit(
+            callback.message,
             "🏠 Главное меню:",
             reply_markup=KeyboardService.get_main_menu_keyboard()
         )
         await state.set_state(AdStates.main_menu)
         await callback.answer()
     except Exception as e:
-        logger.warning(f"Ошибка при возврате в главное меню: {e}")
+        logger.warning("Ошибка при возврате в главное меню: %s", e)
         await callback.answer()
 
-@dp.callback_query(F.data == "back_to_topics")
+@router.callback_query(F.data == "back_to_topics")
 async def back_to_topics_handler(callback: CallbackQuery, state: FSMContext):
     """Возврат к выбору тем"""
-    await callback.message.edit_text(
+    schedule_edit(
+        callback.message,
         "📝 В какую тему хотите написать?",
         reply_markup=KeyboardService.get_topics_keyboard()
     )
@@ -859,169 +1092,160 @@ async def back_to_topics_handler(callback: CallbackQuery, state: FSMContext):
 
 # ==================== УПРАВЛЕНИЕ ОБЪЯВЛЕНИЯМИ ====================
 
-@dp.callback_query(F.data.startswith("view_ad_"))
-async def view_ad_handler(callback: CallbackQuery, state: FSMContext):
+@router.callback_query(AdCallback.filter(F.action == "view"))
+async def view_ad_handler(callback: CallbackQuery, callback_data: AdCallback, state: FSMContext):
     """Просмотр действий с объявлением"""
-    message_id = int(callback.data.split("_")[-1])
-    ad_data = await DatabaseService.get_ad_by_message_id(message_id)
+    message_id = callback_data.message_id
+    ad_data = await DatabaseService.get_user_ad(callback.from_user.id, message_id)
     
     if not ad_data:
         await callback.answer("❌ Объявление не найдено", show_alert=True)
         return
     
-    user_id, message_id, message_url, topic_name = ad_data
-    
-    # Проверяем принадлежность
-    if user_id != callback.from_user.id:
-        await callback.answer("❌ Это не ваше объявление", show_alert=True)
-        return
+    message_id, message_url, topic_name, _ = ad_data
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="🗑 Удалить", callback_data=f"delete_ad_{message_id}"),
-        ],
-        [InlineKeyboardButton(text="👁 Посмотреть", url=message_url)],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="back_to_my_ads")]
-    ])
-    
-    await callback.message.edit_text(
+    schedule_edit(
+        callback.message,
         f"📄 Объявление в теме: {topic_name}\n\nВыберите действие:",
-        reply_markup=keyboard
+        reply_markup=KeyboardService.get_ad_actions_keyboard(message_id, message_url)
     )
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("delete_ad_"))
-async def delete_ad_handler(callback: CallbackQuery, state: FSMContext):
+@router.callback_query(AdCallback.filter(F.action == "delete"))
+async def delete_ad_handler(callback: CallbackQuery, callback_data: AdCallback, state: FSMContext):
     """Подтверждение удаления объявления"""
-    message_id = int(callback.data.split("_")[-1])
-    
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="❌ Отмена", callback_data=f"cancel_delete_{message_id}"),
-            InlineKeyboardButton(text="✅ Удалить", callback_data=f"confirm_delete_{message_id}")
-        ]
-    ])
-    
-    await callback.message.edit_text(
-        "⚠️ Вы точно хотите удалить это объявление?\n\nЭто действие нельзя отменить!",
-        reply_markup=keyboard
-    )
-    await callback.answer("⚠️ Подтвердите удаление объявления", show_alert=True)
+    message_id = callback_data.message_id
+    
+    async with get_chat_lock(callback.message.chat.id):
+        cancel_pending_edit(callback.message)
+        # Повторное нажатие даёт «message is not modified» — это не ошибка обработчика
+        edit_result, answer_result = await asyncio.gather(
+            callback.message.edit_text(
+                "⚠️ Вы точно хотите удалить это объявление?\n\nЭто действие нельзя отменить!",
+                reply_markup=KeyboardService.get_delete_confirm_keyboard(message_id)
+            ),
+            callback.answer("⚠️ Подтвердите удаление объявления", show_alert=True),
+            return_exceptions=True
+        )
+        for result in (edit_result, answer_result):
+            if isinstance(result, Exception):
+                logger.warning("Ошибка показа подтверждения удаления %s: %s", message_id, result)
 
-@dp.callback_query(F.data.startswith("cancel_delete_"))
-async def cancel_delete_handler(callback: CallbackQuery, state: FSMContext):
+@router.callback_query(AdCallback.filter(F.action == "cancel_delete"))
+async def cancel_delete_handler(callback: CallbackQuery, callback_data: AdCallback, state: FSMContext):
     """Отмена удаления объявления"""
-    message_id = int(callback.data.split("_")[-1])
-    ad_data = await DatabaseService.get_ad_by_message_id(message_id)
+    message_id = callback_data.message_id
+    ad_data = await DatabaseService.get_user_ad(callback.from_user.id, message_id)
     
     if not ad_data:
         await callback.answer("❌ Объявление не найдено", show_alert=True)
         return
     
-    user_id, message_id, message_url, topic_name = ad_data
-    
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="🗑 Удалить", callback_data=f"delete_ad_{message_id}"),
-        ],
-        [InlineKeyboardButton(text="👁 Посмотреть", url=message_url)],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="back_to_my_ads")]
-    ])
+    message_id, message_url, topic_name, _ = ad_data
     
-    await callback.message.edit_text(
+    schedule_edit(
+        callback.message,
         f"📄 Объявление в теме: {topic_name}\n\nВыберите действие:",
-        reply_markup=keyboard
+        reply_markup=KeyboardService.get_ad_actions_keyboard(message_id, message_url)
     )
     await callback.answer("Удаление отменено")
 
-@dp.callback_query(F.data.startswith("confirm_delete_"))
-async def confirm_delete_handler(callback: CallbackQuery, state: FSMContext):
+@router.callback_query(AdCallback.filter(F.action == "confirm_delete"))
+async def confirm_delete_handler(callback: CallbackQuery, callback_data: AdCallback, state: FSMContext):
     """Подтверждение удаления объявления"""
     try:
-        message_id = int(callback.data.split("_")[-1])
-        ad_data = await DatabaseService.get_ad_by_message_id(message_id)
-        
-        if not ad_data:
-            await callback.answer("❌ Объявление не найдено", show_alert=True)
-            return
-        
-        user_id, message_id, message_url, topic_name = ad_data
-        
-        # Проверяем принадлежность
-        if user_id != callback.from_user.id:
-            await callback.answer("❌ Это не ваше объявление", show_alert=True)
-            return
+        message_id = callback_data.message_id
         
-        try:
-            # Пытаемся удалить сообщение из чата
-            await bot.delete_message(chat_id=Config.TARGET_CHAT_ID, message_id=message_id)
-        except Exception as e:
-            logger.warning(f"Не удалось удалить сообщение {message_id} из чата: {e}")
-        
-        # Удаляем из БД
-        await DatabaseService.delete_user_ad(message_id)
-        
-        # Возвращаемся к списку объявлений
-        ads = await DatabaseService.get_user_ads_with_counts(callback.from_user.id)
-        user_limit = await get_user_limit(callback.from_user.id)
-        
-        if not ads:
-            await callback.message.edit_text(
-                "✅ Объявление удалено!\n\nУ вас больше нет объявлений.",
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="⬅️ В главное меню", callback_data="back_to_main")]
-                ])
+        # Повторное нажатие «Удалить» ждёт первое и уже не найдёт объявление
+        async with get_chat_lock(callback.message.chat.id):
+            # Объявление ищем только среди своих — это и есть проверка принадлежности
+            if not await DatabaseService.get_user_ad(callback.from_user.id, message_id):
+                await callback.answer("❌ Объявление не найдено", show_alert=True)
+                return
+            
+            try:
+                # Пытаемся удалить сообщение из чата
+                await bot.delete_message(chat_id=Config.TARGET_CHAT_ID, message_id=message_id)
+            except Exception as e:
+                logger.warning("Не удалось удалить сообщение %s из чата: %s", message_id, e)
+            
+            # Удаляем из БД
+            await DatabaseService.delete_user_ad(message_id)
+            
+            # Возвращаемся к списку объявлений
+            ads, user_limit = await asyncio.gather(
+                DatabaseService.get_user_ads(callback.from_user.id),
+                get_user_limit(callback.from_user.id)
             )
-        else:
-            keyboard = await get_my_ads_keyboard(callback.from_user.id)
-            await callback.message.edit_text(
-                f"✅ Объявление удалено!\n\n📋 Ваши объявления ({len(ads)}/{user_limit}):",
-                reply_markup=keyboard
+            
+            if not ads:
+                text = "✅ Объявление удалено!\n\nУ вас больше нет объявлений."
+                keyboard = KeyboardService.get_no_ads_keyboard()
+            else:
+                text = f"✅ Объявление удалено!\n\n📋 Ваши объявления ({len(ads)}/{user_limit}):"
+                keyboard = await get_my_ads_keyboard(callback.from_user.id)
+            
+            cancel_pending_edit(callback.message)
+            # Редактирование и ответ на callback независимы — отправляем параллельно.
+            # Объявление к этому моменту уже удалено, поэтому ошибки отправки
+            # только логируем: повторный ответ на callback Telegram отклонит
+            edit_result, answer_result = await asyncio.gather(
+                callback.message.edit_text(text, reply_markup=keyboard),
+                callback.answer("✅ Объявление успешно удалено!", show_alert=True),
+                return_exceptions=True
             )
-        
-        await callback.answer("✅ Объявление успешно удалено!", show_alert=True)
+            for result in (edit_result, answer_result):
+                if isinstance(result, Exception):
+                    logger.warning("Ошибка ответа после удаления объявления %s: %s", message_id, result)
         
     except Exception as e:
-        logger.error(f"Ошибка при удалении объявления: {e}")
+        logger.error("Ошибка при удалении объявления: %s", e)
         await callback.answer("❌ Ошибка при удалении", show_alert=True)
 
-@dp.callback_query(F.data == "back_to_my_ads")
+@router.callback_query(F.data.regexp(r"^(view_ad|delete_ad|cancel_delete|confirm_delete)_\d+$"))
+async def legacy_ad_button_handler(callback: CallbackQuery, state: FSMContext):
+    """Кнопки объявлений в старом формате callback_data, отправленные до AdCallback"""
+    await callback.answer("⚠️ Это меню устарело. Откройте его заново: /start", show_alert=True)
+
+@router.callback_query(F.data == "back_to_my_ads")
 async def back_to_my_ads_handler(callback: CallbackQuery, state: FSMContext):
     """Возврат к моим объявлениям"""
     try:
         user_id = callback.from_user.id
-        ads = await DatabaseService.get_user_ads(user_id)
-        user_limit = await get_user_limit(user_id)
+        ads, user_limit = await asyncio.gather(
+            DatabaseService.get_user_ads(user_id),
+            get_user_limit(user_id)
+        )
         
         if not ads:
-            await callback.message.edit_text(
+            schedule_edit(
+                callback.message,
                 "🏠 Главное меню:",
                 reply_markup=KeyboardService.get_main_menu_keyboard()
             )
             await state.set_state(AdStates.main_menu)
         else:
             keyboard = await get_my_ads_keyboard(user_id)
-            await callback.message.edit_text(
+            schedule_edit(
+                callback.message,
                 f"📋 Ваши объявления ({len(ads)}/{user_limit}):",
                 reply_markup=keyboard
             )
             await state.set_state(AdStates.my_ads)
         await callback.answer()
     except Exception as e:
-        logger.warning(f"Ошибка при возврате к объявлениям: {e}")
+        logger.warning("Ошибка при возврате к объявлениям: %s", e)
         await callback.answer()
 
 # ==================== КОМАНДЫ МОДЕРАЦИИ ====================
 
-@dp.message(Command("ban"))
+# Команды модерации принимаются только из чата модерации
+# (при MODERATION_CHAT_ID = 0 фильтр не пропускает ни одного сообщения)
+MODERATION_ONLY = F.chat.id == Config.MODERATION_CHAT_ID
+
+@router.message(Command("ban"), MODERATION_ONLY)
 async def ban_command(message: Message):
     """Команда бана пользователя"""
-    if message.chat.id == Config.TARGET_CHAT_ID:
-        return
-    
-    if not Config.MODERATION_CHAT_ID or message.chat.id != Config.MODERATION_CHAT_ID:
-        return
-    
     try:
         args = message.text.split()
         if len(args) != 2:
@@ -1030,7 +1254,7 @@ async def ban_command(message: Message):
         
         user_id = int(args[1])
         await DatabaseService.ban_user(user_id)
-        await notify_user(user_id, "🚫 Вы были заблокированы администрацией.")
+        notify_user_background(user_id, "🚫 Вы были заблокированы администрацией.")
         await message.answer(f"✅ Пользователь {user_id} забанен")
         
     except ValueError:
@@ -1038,15 +1262,9 @@ async def ban_command(message: Message):
     except Exception as e:
         await message.answer(f"❌ Ошибка: {e}")
 
-@dp.message(Command("banoff"))
+@router.message(Command("banoff"), MODERATION_ONLY)
 async def banoff_command(message: Message):
     """Команда разбана пользователя"""
-    if message.chat.id == Config.TARGET_CHAT_ID:
-        return
-    
-    if not Config.MODERATION_CHAT_ID or message.chat.id != Config.MODERATION_CHAT_ID:
-        return
-    
     try:
         args = message.text.split()
         if len(args) != 2:
@@ -1062,7 +1280,7 @@ async def banoff_command(message: Message):
         
         # Разбаниваем пользователя
         await DatabaseService.unban_user(user_id)
-        await notify_user(user_id, "✅ Ваша блокировка снята. Теперь вы можете снова размещать объявления.")
+        notify_user_background(user_id, "✅ Ваша блокировка снята. Теперь вы можете снова размещать объявления.")
         
         await message.answer(f"✅ Пользователь {user_id} разбанен")
         
@@ -1071,15 +1289,9 @@ async def banoff_command(message: Message):
     except Exception as e:
         await message.answer(f"❌ Ошибка: {e}")
 
-@dp.message(Command("setlimit"))
+@router.message(Command("setlimit"), MODERATION_ONLY)
 async def setlimit_command(message: Message):
     """Команда установки лимита объявлений"""
-    if message.chat.id == Config.TARGET_CHAT_ID:
-        return
-    
-    if not Config.MODERATION_CHAT_ID or message.chat.id != Config.MODERATION_CHAT_ID:
-        return
-    
     try:
         args = message.text.split()
         if len(args) != 3:
@@ -1102,9 +1314,9 @@ async def setlimit_command(message: Message):
         
         # Уведомляем пользователя
         if limit > old_limit:
-            await notify_user(user_id, f"📈 Ваш лимит объявлений увеличен с {old_limit} до {limit}.")
+            notify_user_background(user_id, f"📈 Ваш лимит объявлений увеличен с {old_limit} до {limit}.")
         elif limit < old_limit:
-            await notify_user(user_id, f"📉 Ваш лимит объявлений уменьшен с {old_limit} до {limit}.")
+            notify_user_background(user_id, f"📉 Ваш лимит объявлений уменьшен с {old_limit} до {limit}.")
         
         await message.answer(f"✅ Лимит для пользователя {user_id} установлен: {limit} объявлений")
         
@@ -1113,15 +1325,9 @@ async def setlimit_command(message: Message):
     except Exception as e:
         await message.answer(f"❌ Ошибка: {e}")
 
-@dp.message(Command("getlimit"))
+@router.message(Command("getlimit"), MODERATION_ONLY)
 async def getlimit_command(message: Message):
     """Команда получения лимита объявлений"""
-    if message.chat.id == Config.TARGET_CHAT_ID:
-        return
-    
-    if not Config.MODERATION_CHAT_ID or message.chat.id != Config.MODERATION_CHAT_ID:
-        return
-    
     try:
         args = message.text.split()
         if len(args) != 2:
@@ -1129,9 +1335,8 @@ async def getlimit_command(message: Message):
             return
         
         user_id = int(args[1])
-        current_count = await DatabaseService.get_user_ad_count(user_id)
-        user_limit = await get_user_limit(user_id)
-        
+        current_count, user_limit = await DatabaseService.get_user_stats(user_id)
+
         await message.answer(
             f"👤 Пользователь: {user_id}\n"
             f"📊 Объявлений: {current_count}/{user_limit}\n"
@@ -1143,14 +1348,6 @@ async def getlimit_command(message: Message):
     except Exception as e:
         await message.answer(f"❌ Ошибка: {e}")
 
-# ==================== БЛОКИРОВКА СООБЩЕНИЙ ИЗ ГРУППЫ ====================
-
-@dp.message()
-async def block_target_chat_messages(message: Message):
-    """Блокировка всех сообщений в группе объявлений"""
-    if message.chat.id == Config.TARGET_CHAT_ID:
-        return  # Игнорируем сообщения в группе объявлений
-
 # ==================== АВТОПИНГ ====================
 
 async def ping_self():
@@ -1161,9 +1358,9 @@ async def ping_self():
                 if response.status == 200:
                     logger.info("✅ Self ping successful")
                 else:
-                    logger.warning(f"⚠️ Self ping failed: {response.status}")
+                    logger.warning("⚠️ Self ping failed: %s", response.status)
     except Exception as e:
-        logger.warning(f"⚠️ Self ping error: {e}")
+        logger.warning("⚠️ Self ping error: %s", e)
 
 async def start_ping_task():
     """Запуск задачи автопинга каждые 25 минут"""
@@ -1182,6 +1379,7 @@ async def init_bot():
     
     bot = Bot(token=Config.BOT_TOKEN)
     dp = Dispatcher(storage=storage)
+    dp.include_router(router)
     
     # Установка команд
     commands = [
@@ -1191,7 +1389,7 @@ async def init_bot():
     
     # Установка webhook
     await bot.set_webhook(Config.WEBHOOK_URL)
-    logger.info(f"✅ Webhook установлен: {Config.WEBHOOK_URL}")
+    logger.info("✅ Webhook установлен: %s", Config.WEBHOOK_URL)
 
 async def init_web_app():
     """Инициализация веб-приложения"""
@@ -1199,13 +1397,22 @@ async def init_web_app():
     
     app = web.Application()
     
-    # Health check
+    # Health check: id бота берётся из токена, без запроса к Bot API
+    health_payload = {
+        "status": "ok",
+        "timestamp": None,
+        "bot_id": bot.id if bot else None
+    }
+    # Время обновляется не чаще раза в секунду, сколько бы проверок ни пришло
+    health_refreshed_at = -1.0
+    
     async def health(request):
-        return web.json_response({
-            "status": "ok",
-            "timestamp": datetime.now().isoformat(),
-            "bot_id": (await bot.get_me()).id if bot else None
-        })
+        nonlocal health_refreshed_at
+        now = time.monotonic()
+        if now - health_refreshed_at >= 1:
+            health_payload["timestamp"] = datetime.now().isoformat()
+            health_refreshed_at = now
+        return web.json_response(health_payload)
     
     app.router.add_get('/health', health)
     
@@ -1231,7 +1438,7 @@ async def cleanup():
         
         logger.info("✅ Ресурсы очищены")
     except Exception as e:
-        logger.error(f"❌ Ошибка очистки: {e}")
+        logger.error("❌ Ошибка очистки: %s", e)
 
 # ==================== ГЛАВНАЯ ФУНКЦИЯ ====================
 
@@ -1247,17 +1454,21 @@ async def main():
         await init_web_app()
         
         # Запуск сервера
-        runner = web.AppRunner(app)
+        # Access log отключен: каждый webhook POST иначе пишет строку в лог
+        runner = web.AppRunner(app, access_log=None)
         await runner.setup()
         site = web.TCPSite(runner, '0.0.0.0', Config.PORT)
         await site.start()
         
-        logger.info(f"🌐 Сервер запущен на порту {Config.PORT}")
+        logger.info("🌐 Сервер запущен на порту %s", Config.PORT)
         
         # Запуск автопинга
         asyncio.create_task(start_ping_task())
         logger.info("🔄 Автопинг запущен (каждые 25 минут)")
         
+        asyncio.create_task(start_rate_limiter_sweep_task())
+        asyncio.create_task(start_cache_sweep_task())
+        
         logger.info("✅ Все сервисы успешно запущены")
         
         # Ожидание завершения
@@ -1267,10 +1478,13 @@ async def main():
             logger.info("🛑 Получен сигнал завершения")
     
     except Exception as e:
-        logger.error(f"❌ Критическая ошибка: {e}")
+        logger.error("❌ Критическая ошибка: %s", e)
         raise
     finally:
         await cleanup()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if uvloop:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())